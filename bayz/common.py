@@ -11,10 +11,11 @@ import os.path
 import pickle
 import random
 
-from collections import defaultdict, Counter
+from collections import defaultdict, Counter, OrderedDict
 
 import numpy as np
 from sklearn.mixture import BayesianGaussianMixture
+import scipy.linalg
 import scipy.stats
 
 class BayesianGaussianTypeModel:
@@ -23,7 +24,8 @@ class BayesianGaussianTypeModel:
     additional project-relevant sampling procedures and calculation
     """
 
-    def __init__(self, embedding, n_components=32, smooth: int = 0.01, do_conditional: bool = True):
+    def __init__(self, embedding, n_components=32, smooth: int = 0.01, do_conditional: bool = True,
+                 cache_size: int = 512):
         """
         param embedding: gensim.Word2Vec model
         param n_components: number of mixtures to fit. Not an exact number -- it
@@ -31,6 +33,10 @@ class BayesianGaussianTypeModel:
         param smooth: smoothing factor for unseen n-grams
         param do_conditional: whether to apply conditional calculations when
                               sampling
+        param cache_size: maximum number of (type_id, context) emission
+                          distributions to keep in memory. Each takes 8 bytes
+                          per vocabulary word, so the cache is bounded by
+                          8 * cache_size * vocabulary size bytes
         """
 
         self.embedding = embedding
@@ -41,6 +47,12 @@ class BayesianGaussianTypeModel:
 
         # Set up function caching
         self.norm_prob_cache = {}
+        self.dist_cache = OrderedDict()
+        self.cache_size = cache_size
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.vocab = None
+        self.vocab_index = None
 
     def fit(self, scores):
         """
@@ -52,6 +64,7 @@ class BayesianGaussianTypeModel:
 
         self.mixture = BayesianGaussianMixture(n_components=self.n)
         self.mixture.fit(self.embedding.wv.vectors)
+        self._factorize()
         # Fit conditional dependence model
         # Compute n-gram model
         gram_map = { 2: defaultdict(Counter), 3: defaultdict(Counter) }
@@ -62,6 +75,7 @@ class BayesianGaussianTypeModel:
                     gram = tuple(score[i:i+n_gram-1])
                     gram_map[n_gram][gram][followed] += 1
         self.gram_map = gram_map
+        self.clear_cache()
 
 
     def predict(self, vector):
@@ -83,32 +97,170 @@ class BayesianGaussianTypeModel:
             smooth_count += followers[option] + self.smooth #*((n_gram-1)**2) + self.smooth
         return smooth_count
 
-    def emit(self, type_id, prev_words=[]):
+    def emit(self, type_id, prev_words=[], rng=None):
         """
         Samples a new token for the given mixture id based in previously
-        observed tokens
+        observed tokens. If rng (a numpy.random.Generator) is given, all
+        randomness is drawn from it instead of the global random state
         """
 
-        mean = self.mixture.means_[type_id,:]
-        cov = self.mixture.covariances_[type_id,:,:]
         if len(prev_words) == [] or not self.do_conditional: # if not conditioning on previous
-            draw = np.random.multivariate_normal(mean, cov)
+            draw = self.emit_unconditional([type_id], rng)[0]
         else:
-            opts = list(self.embedding.vocab)
-            weights = []
-            if not type_id in self.norm_prob_cache:
-                self.norm_prob_cache[type_id] = [scipy.stats.multivariate_normal(mean, cov).pdf(self.embedding[wrd]) for \
-                              wrd in opts]
-            for i, wrd in enumerate(opts):
-                norm_prob = self.norm_prob_cache[type_id][i]
-                ngram_prob = self.conditional_prob(wrd, prev_words)
-                weights.append(norm_prob*ngram_prob)
-            draw = random.choices(population=opts, k=1, weights=weights)[0]
-            print(draw, type_id)
+            opts, cum_weights = self.emission_dist(type_id, prev_words)
+            uniform = rng.random() if rng is not None else random.random()
+            idx = np.searchsorted(cum_weights, uniform, side='right')
+            draw = opts[min(idx, len(opts) - 1)]
             # convert to vector for legacy support
             draw = self.embedding[draw]
         return draw
 
+    def emit_unconditional(self, types, rng=None) -> np.ndarray:
+        """
+        Samples one vector per mixture id in types directly from the mixture
+        components, without conditioning on previous tokens. Draws sharing a
+        mixture id are made together using the cached Cholesky factors.
+
+        param types: sequence of mixture ids
+        param rng: numpy.random.Generator to draw from. Defaults to the global
+                   numpy random state
+        return: array of shape (len(types), embedding dimension)
+        """
+
+        normal = rng.standard_normal if rng is not None else np.random.standard_normal
+        types = np.asarray(types).flatten()
+        means = self.mixture.means_
+        draws = np.empty((len(types), means.shape[1]))
+        for type_id in np.unique(types):
+            idx = np.flatnonzero(types == type_id)
+            noise = normal((len(idx), means.shape[1]))
+            draws[idx] = means[type_id] + noise @ self.chol_factors[type_id].T
+        return draws
+
+    def log_emission(self, types, words) -> np.ndarray:
+        """
+        Computes the log probability of emitting each word in a sequence,
+        given its mixture id and (if conditional) the words before it
+
+        param types: sequence of mixture ids
+        param words: sequence of words, one per mixture id
+        return: array of log probabilities, one per word
+        """
+
+        if not self.do_conditional:
+            vectors = np.array([self.embedding[wrd] for wrd in words])
+            return self.unconditional_logpdf(types, vectors)
+
+        vocab_index = self._vocab_index()
+        log_probs = np.empty(len(words))
+        for i, (type_id, wrd) in enumerate(zip(types, words)):
+            context, _, total = self._emission_weights(type_id, words[:i])
+            # computed directly, as differencing the cumulative weights loses
+            # precision for rare words
+            prob = self.norm_prob_cache[type_id][vocab_index[wrd]] \
+                * self.conditional_prob(wrd, context) / total
+            log_probs[i] = np.log(prob) if prob > 0 else -np.inf
+        return log_probs
+
+    def unconditional_logpdf(self, types, vectors) -> np.ndarray:
+        """
+        Computes the log density of each vector under the mixture component
+        given by the corresponding mixture id, using the cached Cholesky
+        factors
+
+        param types: sequence of mixture ids
+        param vectors: array of shape (len(types), embedding dimension)
+        return: array of log densities
+        """
+
+        types = np.asarray(types).flatten()
+        vectors = np.asarray(vectors).reshape(len(types), -1)
+        dim = vectors.shape[1]
+        log_pdf = np.empty(len(types))
+        for type_id in np.unique(types):
+            idx = np.flatnonzero(types == type_id)
+            chol = self.chol_factors[type_id]
+            diff = vectors[idx] - self.mixture.means_[type_id]
+            white = scipy.linalg.solve_triangular(chol, diff.T, lower=True)
+            log_det = 2 * np.sum(np.log(np.diag(chol)))
+            log_pdf[idx] = -0.5 * (dim * np.log(2 * np.pi) + log_det + np.sum(white ** 2, axis=0))
+        return log_pdf
+
+    def emission_dist(self, type_id, prev_words):
+        """
+        Returns the vocabulary alongside the normalized cumulative weights of
+        emitting each word from the given mixture id. Only the last few words
+        affect the n-gram probabilities, so distributions are cached per
+        (type_id, context) state and evicted least-recently-used first.
+        """
+
+        _, cum_weights, _ = self._emission_weights(type_id, prev_words)
+        return self._vocab(), cum_weights
+
+    def _emission_weights(self, type_id, prev_words):
+        context = tuple(prev_words[-(max(self.n_grams)-1):])
+        key = (int(type_id), context)
+        if key in self.dist_cache:
+            self.cache_hits += 1
+            self.dist_cache.move_to_end(key)
+            return (context,) + self.dist_cache[key]
+
+        self.cache_misses += 1
+        opts = self._vocab()
+        if not type_id in self.norm_prob_cache:
+            mean = self.mixture.means_[type_id,:]
+            cov = self.mixture.covariances_[type_id,:,:]
+            self.norm_prob_cache[type_id] = [scipy.stats.multivariate_normal(mean, cov).pdf(self.embedding[wrd]) for \
+                          wrd in opts]
+
+        weights = [norm_prob * self.conditional_prob(wrd, context) for \
+                   wrd, norm_prob in zip(opts, self.norm_prob_cache[type_id])]
+        cum_weights = np.cumsum(weights)
+        total = cum_weights[-1]
+        cum_weights /= total
+
+        self.dist_cache[key] = (cum_weights, total)
+        if len(self.dist_cache) > self.cache_size:
+            self.dist_cache.popitem(last=False)
+
+        return context, cum_weights, total
+
+    def cache_info(self) -> dict:
+        """
+        Reports hit/miss statistics for the emission distribution cache
+        """
+
+        return {
+            'hits': self.cache_hits,
+            'misses': self.cache_misses,
+            'size': len(self.dist_cache),
+            'max_size': self.cache_size
+        }
+
+    def clear_cache(self):
+        """
+        Drops all cached emission distributions. Called whenever the
+        underlying model parameters change
+        """
+
+        self.norm_prob_cache = {}
+        self.dist_cache.clear()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def _vocab(self) -> list:
+        if self.vocab is None:
+            self.vocab = list(self.embedding.vocab)
+        return self.vocab
+
+    def _vocab_index(self) -> dict:
+        if self.vocab_index is None:
+            self.vocab_index = {wrd: i for i, wrd in enumerate(self._vocab())}
+        return self.vocab_index
+
+    def _factorize(self):
+        self.chol_factors = np.linalg.cholesky(self.mixture.covariances_)
+
     def save_model(self, file_name):
         """
         Pickles the model parameters
@@ -126,3 +278,5 @@ class BayesianGaussianTypeModel:
         data = pickle.loads(s)
         self.mixture = data['mixture']
         self.gram_map = data['gram_map']
+        self._factorize()
+        self.clear_cache()
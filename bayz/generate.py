@@ -13,10 +13,22 @@ to generate a short sample of music. In order to display the music, ensure
 you have a working musicxml renderer configured with music21. For instructions
 on how, see: https://web.mit.edu/music21/doc/usersGuide/usersGuide_08_installingMusicXML.html
 
+To generate many pieces at once without displaying them, use batch mode
+
+$ python -m bayz.generate --batch 1000 --length 16 --texture chord --out generated/
+
+which writes MIDI and MusicXML files to 'generated/' alongside a manifest.json
+describing each piece. Building and writing the scores is spread across a pool
+of processes.
+
 author: William Tong (wlt2115@columbia.edu)
 """
 
+import argparse
+import json
+import os
 import pickle
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 from music21 import bar
@@ -27,6 +39,7 @@ from music21 import tie
 
 import numpy as np
 import scipy
+from tqdm import tqdm
 
 from .common import BayesianGaussianTypeModel
 
@@ -36,6 +49,9 @@ END_WORD = 'END'
 
 norm_prob_cache = {}
 
+""" Number of vectors decoded at a time by _decode_batch """
+DECODE_BLOCK = 1024
+
 def load_model(path: Path) -> 'Any':
     """
     Load a model file from the given path
@@ -48,7 +64,24 @@ def load_model(path: Path) -> 'Any':
         return pickle.load(fp)
 
 
-def to_token(types: list, mixture: BayesianGaussianTypeModel, embedding: 'Word2Vec') -> list:
+def sample_types(hmm, length: int, rng=None) -> np.ndarray:
+    """
+    Samples a sequence of types (mixture ids) from the HMM
+
+    param hmm: a trained hmmlearn.hmm.MultinomialHMM
+    param length: number of types to sample
+    param rng: numpy.random.Generator to draw from. Defaults to the HMM's own
+               random state
+
+    return: array of mixture ids
+    """
+
+    seed = int(rng.integers(2**32)) if rng is not None else None
+    types, _ = hmm.sample(length, random_state=seed)
+    return types.flatten()
+
+
+def to_token(types: list, mixture: BayesianGaussianTypeModel, embedding: 'Word2Vec', rng=None) -> list:
     """
     Samples a set of tokens from the provided mixture model
 
@@ -56,23 +89,75 @@ def to_token(types: list, mixture: BayesianGaussianTypeModel, embedding: 'Word2V
                  generated
     param mixture: a mixture model fitted to a training corpus
     param embedding: a Word2Vec model trained on the corpus
+    param rng: numpy.random.Generator to draw from. Defaults to the global
+               random state
 
     return: a list of abstract note names, ready to be sampled into real music
     """
 
+    if not mixture.do_conditional:
+        return to_token_batch([types], mixture, embedding, rng)[0]
+
     words = []
     for symbol in types:
-        new_vec = mixture.emit(symbol, words) # instantiate and use previous words
+        new_vec = mixture.emit(symbol, words, rng) # instantiate and use previous words
         words.append(_decode(embedding, new_vec))
     token_seq = [word.split('_') for word in words]
 
     return token_seq
 
 
+def to_token_batch(type_seqs: list, mixture: BayesianGaussianTypeModel, embedding: 'Word2Vec', rng=None) -> list:
+    """
+    Samples tokens for several sequences of types at once. When the mixture
+    is not conditional, every note across all sequences is drawn and decoded
+    in a single batch.
+
+    param type_seqs: a list of type sequences, as accepted by to_token
+    param mixture: a mixture model fitted to a training corpus
+    param embedding: a Word2Vec model trained on the corpus
+    param rng: numpy.random.Generator to draw from. Defaults to the global
+               random state
+
+    return: a list of token sequences, one per sequence of types
+    """
+
+    if mixture.do_conditional:
+        return [to_token(types, mixture, embedding, rng) for types in type_seqs]
+
+    type_seqs = [np.asarray(types, dtype=int).flatten() for types in type_seqs]
+    if len(type_seqs) == 0:
+        return []
+
+    vectors = mixture.emit_unconditional(np.concatenate(type_seqs), rng)
+    words = _decode_batch(embedding, vectors)
+
+    token_seqs = []
+    start = 0
+    for types in type_seqs:
+        stop = start + len(types)
+        token_seqs.append([word.split('_') for word in words[start:stop]])
+        start = stop
+
+    return token_seqs
+
+
 def _decode(embedding, vector):
     return embedding.similar_by_vector(vector, topn=1)[0][0]
 
 
+def _decode_batch(embedding, vectors, block_size=DECODE_BLOCK):
+    embedding.init_sims()
+    vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    # decode in blocks of rows to bound the size of the similarity matrix
+    best = np.empty(len(vectors), dtype=int)
+    for start in range(0, len(vectors), block_size):
+        block = vectors[start:start+block_size]
+        best[start:start+block_size] = np.argmax(block @ embedding.vectors_norm.T, axis=1)
+    return [embedding.index2word[idx] for idx in best]
+
+
 def to_score(token_seq: list, texture: 'function', **texture_args) -> 'Score':
     """
     Samples a music21.Score object from a list of tokens
@@ -106,7 +191,6 @@ def chord_texture(token_seq, duration=1):
         elif token[0] in (START_WORD, END_WORD):
             yield bar.Barline('double')
         else:
-            print('processing token', token)
             yield chord.Chord(set(token), quarterLength=duration)
 
 
@@ -123,12 +207,16 @@ def chord_with_ties_texture(token_seq, duration=1):
     chords = chord_texture(token_seq, duration)
     chords_with_ties = []
 
-    prev = next(chords)
+    prev = next(chords, None)
+    if prev is None:
+        return chords_with_ties
+
     for stack in chords:
         if type(stack) is chord.Chord:
-            for elem in prev:
-                if elem in stack:
-                    elem.tie = tie.Tie()
+            if type(prev) is chord.Chord:
+                for elem in prev:
+                    if elem in stack:
+                        elem.tie = tie.Tie()
             chords_with_ties.append(prev)
             prev = stack
 
@@ -186,16 +274,117 @@ def to_midi(token_seq: list, use_last=False) -> list:
 
 
 
+def export_batch(type_seqs: list, token_seqs: list, out_path: Path, texture='melody',
+                 formats=('midi', 'musicxml'), workers=None) -> list:
+    """
+    Renders many token sequences to score files in parallel, and writes a
+    manifest describing them
+
+    param type_seqs: the types each token sequence was sampled from
+    param token_seqs: token sequences to render
+    param out_path: directory in which to write the files
+    param texture: name of the texture to render with, one of TEXTURES
+    param formats: music21 formats to write each score in
+    param workers: number of processes to use. Defaults to the CPU count
+
+    return: manifest entries, one per piece. Pieces that failed to render
+            have no files, and record the error instead
+    """
+
+    out_path.mkdir(parents=True, exist_ok=True)
+    jobs = [(i, tokens, out_path, texture, formats) for i, tokens in enumerate(token_seqs)]
+    chunksize = max(1, len(jobs) // (4 * (workers or os.cpu_count() or 1)))
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(tqdm(pool.map(_export, jobs, chunksize=chunksize), total=len(jobs)))
+
+    manifest = []
+    for i, (types, tokens) in enumerate(zip(type_seqs, token_seqs)):
+        files, error = results[i]
+        entry = {
+            'index': i,
+            'texture': texture,
+            'types': [int(t) for t in types],
+            'tokens': ['_'.join(token) for token in tokens],
+            'files': files
+        }
+        if error is not None:
+            entry['error'] = error
+        manifest.append(entry)
+
+    failed = sum(1 for _, error in results if error is not None)
+    if failed > 0:
+        print('failed to export %d of %d pieces, see manifest.json' % (failed, len(jobs)))
+
+    with (out_path / 'manifest.json').open('w') as fp:
+        json.dump(manifest, fp, indent=2)
+
+    return manifest
+
+
+def _export(job) -> tuple:
+    idx, tokens, out_path, texture, formats = job
+
+    files = []
+    try:
+        score = to_score(tokens, TEXTURES[texture])
+        for fmt in formats:
+            name = 'piece_%05d.%s' % (idx, FORMAT_SUFFIXES[fmt])
+            score.write(fmt, fp=out_path / name)
+            files.append(name)
+    except Exception as e:
+        return files, '%s: %s' % (type(e).__name__, e)
+    return files, None
+
+
+TEXTURES = {
+    'melody': melody_texture,
+    'chord': chord_texture,
+    'chord_with_ties': chord_with_ties_texture
+}
+
+FORMAT_SUFFIXES = {
+    'midi': 'mid',
+    'musicxml': 'musicxml'
+}
+
+
 if __name__ == '__main__':
-    embedding = load_model(Path('save/embedding.wv'))
-    mixture = BayesianGaussianTypeModel(embedding)
-    mixture.load_model(Path('save/mixture.pk'))
-    hmm = load_model(Path('save/hmm.pk'))
-
-    types, _ = hmm.sample(5)
-    types = types.flatten()
-    print('Sampled', types)
-
-    tokens = to_token(types, mixture, embedding)
-    score = to_score(tokens, melody_texture)
-    score.show('musicxml')
+    parser = argparse.ArgumentParser(description='Generate music from trained bayz models')
+    parser.add_argument('--model', type=Path, default=Path('save/'), help='location of saved model files')
+    parser.add_argument('--batch', type=int, default=None, help='number of pieces to generate and export')
+    parser.add_argument('--length', type=int, default=5, help='number of tokens per piece')
+    parser.add_argument('--texture', choices=list(TEXTURES), default='melody')
+    parser.add_argument('--format', choices=list(FORMAT_SUFFIXES) + ['both'], default='both')
+    parser.add_argument('--out', type=Path, default=Path('generated/'), help='directory for batch output')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes for batch export')
+    parser.add_argument('--seed', type=int, default=None, help='seed for reproducible generation')
+    parser.add_argument('--unconditional', action='store_true',
+                        help='sample tokens without conditioning on previous ones, which is much faster')
+    args = parser.parse_args()
+    rng = np.random.default_rng(args.seed)
+
+    embedding = load_model(args.model / 'embedding.wv')
+    mixture = BayesianGaussianTypeModel(embedding, do_conditional=not args.unconditional)
+    mixture.load_model(args.model / 'mixture.pk')
+    hmm = load_model(args.model / 'hmm.pk')
+
+    if args.batch is None:
+        types = sample_types(hmm, args.length, rng)
+        print('Sampled', types)
+
+        tokens = to_token(types, mixture, embedding, rng)
+        score = to_score(tokens, TEXTURES[args.texture])
+        score.show('musicxml')
+    else:
+        print('sampling %d pieces' % args.batch)
+        # all sampling happens here, so the output for a given seed does not
+        # depend on the number of export workers
+        type_seqs = [sample_types(hmm, args.length, rng) for _ in range(args.batch)]
+        token_seqs = to_token_batch(type_seqs, mixture, embedding, rng)
+
+        formats = list(FORMAT_SUFFIXES) if args.format == 'both' else [args.format]
+        print('exporting to', args.out)
+        export_batch(type_seqs, token_seqs, args.out, texture=args.texture,
+                     formats=formats, workers=args.workers)
+        print('done!')
@@ -0,0 +1,81 @@
+"""
+Scores generated sequences under a trained BPL model. The log-likelihood of a
+sequence is the log probability of its types (mixture ids) under the HMM,
+computed with the forward algorithm, plus the log probability of emitting each
+token from its type under the mixture model. Many candidate sequences are
+scored at once, which makes it cheap to generate several candidates and keep
+only the best.
+
+author: William Tong (wlt2115@columbia.edu)
+"""
+
+import numpy as np
+from scipy.special import logsumexp
+
+from .common import BayesianGaussianTypeModel
+
+
+def score_sequences(type_seqs: list, token_seqs: list, hmm, mixture: BayesianGaussianTypeModel) -> np.ndarray:
+    """
+    Computes the log-likelihood of many sequences under the trained model
+
+    param type_seqs: sequences of types (mixture ids)
+    param token_seqs: token sequences sampled from the types, as produced by
+                      bayz.generate.to_token
+    param hmm: a trained hmmlearn.hmm.MultinomialHMM
+    param mixture: a mixture model fitted to a training corpus
+
+    return: array of log-likelihoods, one per sequence
+    """
+
+    type_seqs = [np.asarray(types, dtype=int).flatten() for types in type_seqs]
+    word_seqs = [['_'.join(token) for token in tokens] for tokens in token_seqs]
+
+    scores = hmm_log_likelihood(hmm, type_seqs)
+    if len(type_seqs) == 0:
+        return scores
+
+    if mixture.do_conditional:
+        scores += [mixture.log_emission(types, words).sum() for \
+                   types, words in zip(type_seqs, word_seqs)]
+    else:
+        words = [wrd for words in word_seqs for wrd in words]
+        vectors = np.array([mixture.embedding[wrd] for wrd in words])
+        log_probs = mixture.unconditional_logpdf(np.concatenate(type_seqs), vectors)
+        seq_ids = np.repeat(np.arange(len(type_seqs)), [len(types) for types in type_seqs])
+        scores += np.bincount(seq_ids, weights=log_probs, minlength=len(type_seqs))
+    return scores
+
+
+def hmm_log_likelihood(hmm, type_seqs: list) -> np.ndarray:
+    """
+    Runs the forward algorithm over many sequences at once. Sequences of
+    different lengths are padded, and stop accumulating once they end.
+
+    param hmm: a trained hmmlearn.hmm.MultinomialHMM
+    param type_seqs: sequences of types (mixture ids)
+
+    return: array of log-likelihoods, one per sequence
+    """
+
+    lengths = np.array([len(types) for types in type_seqs], dtype=int)
+    if len(lengths) == 0 or lengths.max() == 0:
+        return np.zeros(len(lengths))
+
+    obs = np.zeros((len(lengths), lengths.max()), dtype=int)
+    for i, types in enumerate(type_seqs):
+        obs[i,:len(types)] = types
+
+    with np.errstate(divide='ignore'):
+        log_start = np.log(hmm.startprob_)
+        log_trans = np.log(hmm.transmat_)
+        log_emit = np.log(hmm.emissionprob_).T
+
+    alpha = log_start + log_emit[obs[:,0]]
+    for t in range(1, obs.shape[1]):
+        step = logsumexp(alpha[:,:,None] + log_trans, axis=1) + log_emit[obs[:,t]]
+        alpha = np.where((t < lengths)[:,None], step, alpha)
+
+    scores = logsumexp(alpha, axis=1)
+    scores[lengths == 0] = 0
+    return scores
@@ -12,31 +12,70 @@ and a set of model files will be saved to 'save/'
 author: William Tong (wlt2115@columbia.edu)
 """
 
+import threading
+
 from pathlib import Path
 
-from bayz.common import BayesianGaussianTypeModel
-from bayz.generate import load_model, to_token, to_midi
+import numpy as np
+
+from bayz.registry import LoadedModel, ModelRegistry, fingerprint, is_retrained
+
+DEFAULT_MODEL = 'default'
 
 class Band:
-    def __init__(self, cycleLength=2, model_path=Path('save/'), pre_gen=3):
+    def __init__(self, cycleLength=2, model_path=Path('save/'), pre_gen=3,
+                 max_models=4, memory_budget=None, best_of=1, min_score=None,
+                 service=None, seed=None, do_conditional=True):
         """
         param cycleLength: duration of a cycle, in seconds. One cycle
                            corresponds to one loop through a line of notes.
         param model_path: location of saved model files
         param pre_gen: number of sampled music sequences to cache on start-up
+        param max_models: maximum number of models to keep loaded at once
+        param memory_budget: approximate upper bound (in bytes) on the size of
+                             loaded models. None for no bound
+        param best_of: number of candidate sequences to draw per sample. The
+                       candidates are scored under the model, and the most
+                       likely one is kept
+        param min_score: if set, keep the first candidate whose log-likelihood
+                         reaches this value instead of the most likely one
+        param service: a bayz.service.GenerationClient. If given, music is
+                       sampled by a shared generation service instead of
+                       models loaded in this process
+        param seed: seed for reproducible sampling. Each model gets its own
+                    random stream spawned from it, and each sample a stream
+                    spawned from its model's. Reloads draw from a separate
+                    stream per model. None for fresh entropy
+        param do_conditional: whether to condition each sampled token on the
+                              ones before it. Unconditional sampling is much
+                              faster, but less coherent. Ignored when
+                              sampling from a service
         """
 
-        if type(model_path) == str:
-            model_path = Path(model_path)
-
         print('starting band...')
-        self._load_model(model_path)
+        self.registry = ModelRegistry(max_models=max_models, memory_budget=memory_budget,
+                                      do_conditional=do_conditional)
+        self.pre_gen = pre_gen
+        self.best_of = best_of
+        self.min_score = min_score
+        self.service = service
+
+        self.seed = np.random.SeedSequence(seed)
+        self.model_seeds = {}
+        self.reload_seeds = {}
+        self.seed_lock = threading.Lock()
+        self.warming = {}
 
         self.cycleLength = cycleLength
         self.lines = []
 
-        self.cache = [self._sample() for _ in range(pre_gen)]
-        self.cache_idx = 0
+        self.cache = {}
+        self.cache_idx = {}
+        self.add_model(DEFAULT_MODEL, model_path, preload=True)
+
+        self.reloads = {}
+        self.reload_lock = threading.Lock()
+        self.watcher = None
 
         print('all systems loaded, band ready')
 
@@ -51,20 +90,168 @@ class Band:
         self.server = server
 
     
-    def _load_model(self, model_path: Path):
-        self.embedding = load_model(model_path / 'embedding.wv')
-        self.mixture = BayesianGaussianTypeModel(self.embedding)
-        self.mixture.load_model(model_path / 'mixture.pk')
-        self.hmm = load_model(model_path / 'hmm.pk')
-    
+    def add_model(self, name, model_path, preload=False):
+        """
+        Registers another trained model that players can sample from. Models
+        are loaded on first use, and only the most recently used ones are kept
+        in memory.
+
+        param name: name used to select the model in add_player
+        param model_path: location of saved model files
+        param preload: whether to load the model and cache pre_gen samples
+                       now, rather than on first use
+        """
+
+        self.registry.register(name, model_path)
+        with self.seed_lock:
+            if name not in self.model_seeds:
+                self.model_seeds[name], self.reload_seeds[name] = self.seed.spawn(2)
+
+        self.cache[name] = []
+        self.cache_idx[name] = 0
+        self.warming.pop(name, None)
 
-    def _sample(self) -> 'list':
-        types, _ = self.hmm.sample(1)
-        types = types.flatten()
-        tokens = to_token(types, self.mixture, self.embedding)
-        notes = list(to_midi(tokens))
+        if preload:
+            self._warm(name)
 
-        return notes
+
+    def _warm(self, name):
+        cache = self.cache[name]
+        if self.service is not None:
+            # fetched in the background, and collected in order before the
+            # cache is next read
+            missing = self.pre_gen - len(cache)
+            if missing > 0 and name not in self.warming:
+                seed = int(self._spawn(name).generate_state(1)[0])
+                self.warming[name] = self.service.request(missing, name, self.best_of, self.min_score, seed)
+            return
+
+        while len(cache) < self.pre_gen:
+            cache.append(self._sample(name))
+
+
+    def _sample(self, name=DEFAULT_MODEL) -> 'list':
+        if self.service is not None:
+            seed = int(self._spawn(name).generate_state(1)[0])
+            return self.service.request(1, name, self.best_of, self.min_score, seed).result()[0]
+
+        rng = np.random.default_rng(self._spawn(name))
+        return self.registry.get(name).sample(self.best_of, self.min_score, rng)
+
+
+    def _collect(self, name):
+        future = self.warming.pop(name, None)
+        if future is not None:
+            try:
+                self.cache[name].extend(future.result())
+            except Exception as e:
+                print('failed to sample from service', e)
+
+
+    def _spawn(self, name, reload=False) -> np.random.SeedSequence:
+        seeds = self.reload_seeds if reload else self.model_seeds
+        with self.seed_lock:
+            return seeds[name].spawn(1)[0]
+
+
+    def watch(self, interval=5):
+        """
+        Starts watching the saved model files in a separate thread. Once a
+        model has been completely retrained, the new model is loaded and
+        warmed up in the background, then swapped in at the next commit.
+
+        param interval: time between checks for new model files, in seconds
+        """
+
+        if self.service is not None:
+            raise RuntimeError('cannot watch model files loaded by a service, call reload after retraining instead')
+
+        if self.watcher is not None:
+            return
+
+        stop = threading.Event()
+
+        def _watch():
+            pending = {}
+            failed = {}
+            while not stop.wait(interval):
+                for name in list(self.cache):
+                    stamp = fingerprint(self.registry.path(name))
+                    if failed.get(name) == stamp:
+                        continue
+                    if is_retrained(self._loaded_fingerprint(name), stamp):
+                        # give the files one more check to settle before
+                        # loading them
+                        if pending.get(name) == stamp:
+                            del pending[name]
+                            try:
+                                self.reload(name)
+                            except Exception as e:
+                                failed[name] = stamp
+                                print('failed to reload model', name, e)
+                        else:
+                            pending[name] = stamp
+
+        self.watcher = (threading.Thread(target=_watch, daemon=True), stop)
+        self.watcher[0].start()
+
+
+    def unwatch(self):
+        """
+        Stops watching for new model files
+        """
+
+        if self.watcher is not None:
+            self.watcher[1].set()
+            self.watcher = None
+
+
+    def reload(self, name=DEFAULT_MODEL):
+        """
+        Loads the named model afresh from disk and samples pre_gen sequences
+        from it. The new model replaces the old one at the next commit. This
+        call blocks, see watch for reloading in the background. When sampling
+        from a service, the service is asked to reload its models instead,
+        which affects every band sharing it.
+
+        param name: name of the model to reload
+        """
+
+        print('reloading model', name)
+        if self.service is not None:
+            self.service.reload().result()
+            model = None
+            seed = int(self._spawn(name, reload=True).generate_state(1)[0])
+            samples = self.service.request(self.pre_gen, name, self.best_of, self.min_score, seed).result()
+        else:
+            model = LoadedModel(self.registry.path(name), self.registry.do_conditional)
+            samples = [model.sample(self.best_of, self.min_score, np.random.default_rng(self._spawn(name, reload=True))) \
+                       for _ in range(self.pre_gen)]
+
+        with self.reload_lock:
+            self.reloads[name] = (model, samples)
+
+
+    def _loaded_fingerprint(self, name):
+        # a reload waiting for the next commit is the newest model
+        with self.reload_lock:
+            if name in self.reloads:
+                return self.reloads[name][0].fingerprint
+        return self.registry.fingerprint(name)
+
+
+    def _apply_reloads(self):
+        with self.reload_lock:
+            reloads = self.reloads
+            self.reloads = {}
+
+        for name, (model, samples) in reloads.items():
+            if model is not None:
+                self.registry.swap(name, model)
+            self.warming.pop(name, None)
+            self.cache[name] = samples
+            self.cache_idx[name] = 0
+            print('swapped in new model', name)
 
     
     def hard_refresh(self):
@@ -72,8 +259,10 @@ class Band:
         Clears the cache of generated music samples
         """
 
-        self.cache = []
-        self.cache_idx = 0
+        self.warming = {}
+        for name in self.cache:
+            self.cache[name] = []
+            self.cache_idx[name] = 0
 
 
     def add_line(self, notes, rhythm=[1], instrument='sine'):
@@ -98,7 +287,7 @@ class Band:
         self.lines.append(line)
 
     
-    def add_player(self, rhythm=[1], instrument='sine'):
+    def add_player(self, rhythm=[1], instrument='sine', model=DEFAULT_MODEL):
         """
         Produces a line of music in the style of add_line, but no notes are
         specified. Instead, a sequence of samples is sampled from the BPL
@@ -106,24 +295,31 @@ class Band:
 
         param rhythm: relative duration of notes
         param instrument: instrument that the notes should be played with
+        param model: name of the model to sample from, as given to add_model
         """
 
-        if self.cache_idx < len(self.cache):
-            notes = self.cache[self.cache_idx]
+        if model not in self.cache:
+            raise KeyError('no model registered under name: %s' % model)
+
+        self._collect(model)
+        cache = self.cache[model]
+        if self.cache_idx[model] < len(cache):
+            notes = cache[self.cache_idx[model]]
         else:
-            notes = self._sample()
-            self.cache.append(notes)
+            notes = self._sample(model)
+            cache.append(notes)
         
         print('sampled notes', notes)
         self.add_line(notes, rhythm=rhythm, instrument=instrument)
-        self.cache_idx += 1
+        self.cache_idx[model] += 1
 
 
     def commit(self):
         """
         Commits the music data to the server. After committing, all music
         data is refreshed. Sampled music in the cache will be reduplicated,
-        allowing it to persist across live code runs.
+        allowing it to persist across live code runs. Any models reloaded
+        since the last commit are swapped in here.
         """
 
         data = {
@@ -135,4 +331,6 @@ class Band:
 
         # reset for next run
         self.lines = []
-        self.cache_idx = 0
+        for name in self.cache_idx:
+            self.cache_idx[name] = 0
+        self._apply_reloads()
@@ -0,0 +1,270 @@
+"""
+Keeps track of the trained models available to a Band. Models are registered
+by name and loaded lazily on first use. Only the most recently used models are
+kept in memory, bounded both by a model count and an (approximate) memory
+budget, so switching between styles mid-set does not require reloading
+everything from disk each time.
+
+author: William Tong (wlt2115@columbia.edu)
+"""
+
+import threading
+
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+from bayz.common import BayesianGaussianTypeModel
+from bayz.generate import load_model, sample_types, to_token_batch, to_midi
+from bayz.likelihood import score_sequences
+
+MODEL_FILES = ('embedding.wv', 'mixture.pk', 'hmm.pk')
+DONE_FILE = 'done'
+
+class LoadedModel:
+    """
+    Bundles the embedding, mixture and HMM loaded from one model directory
+    """
+
+    def __init__(self, model_path: Path, do_conditional=True):
+        """
+        param model_path: directory containing saved model files
+        param do_conditional: whether to condition emissions on previous
+                              tokens. Unconditional sampling is much faster
+        """
+
+        self.path = model_path
+        # taken before reading the files, so a retrain that lands during the
+        # load is still noticed afterwards
+        self.fingerprint = fingerprint(model_path)
+        self.embedding = load_model(model_path / 'embedding.wv')
+        self.mixture = BayesianGaussianTypeModel(self.embedding, do_conditional=do_conditional)
+        self.mixture.load_model(model_path / 'mixture.pk')
+        self.hmm = load_model(model_path / 'hmm.pk')
+
+        # pickled size is a reasonable proxy for the in-memory footprint,
+        # to which the emission caches add up to one float per vocabulary
+        # word for each cached context and each mixture component
+        self.nbytes = sum((model_path / name).stat().st_size for name in MODEL_FILES)
+        if do_conditional:
+            n_words = len(self.embedding.vocab)
+            n_cached = self.mixture.cache_size + self.mixture.n
+            self.nbytes += 8 * n_words * n_cached
+
+    def sample(self, best_of=1, min_score=None, rng=None) -> list:
+        """
+        Samples a sequence of midi notes from the model. If several candidates
+        are drawn, they are scored in one batch and the first scoring at least
+        min_score is kept, or the best one if none do.
+
+        param best_of: number of candidate sequences to draw
+        param min_score: log-likelihood a candidate must reach to be kept
+                         without comparing it to the others
+        param rng: numpy.random.Generator to draw from, for reproducible
+                   sampling
+        """
+
+        type_seqs = [sample_types(self.hmm, 1, rng) for _ in range(best_of)]
+        token_seqs = to_token_batch(type_seqs, self.mixture, self.embedding, rng)
+
+        best = 0
+        if best_of > 1:
+            scores = score_sequences(type_seqs, token_seqs, self.hmm, self.mixture)
+            passing = np.flatnonzero(scores >= min_score) if min_score is not None else []
+            best = passing[0] if len(passing) > 0 else np.argmax(scores)
+
+        return list(to_midi(token_seqs[best]))
+
+
+def fingerprint(model_path: Path) -> tuple:
+    """
+    Summarizes the state of the model files on disk, such that retraining a
+    model changes its fingerprint
+
+    param model_path: directory containing saved model files
+    return: modification times and sizes of each model file, followed by
+            those of the completion marker, or None for missing files
+    """
+
+    stamps = []
+    for name in MODEL_FILES + (DONE_FILE,):
+        path = model_path / name
+        if path.exists():
+            stat = path.stat()
+            stamps.append((stat.st_mtime_ns, stat.st_size))
+        else:
+            stamps.append(None)
+    return tuple(stamps)
+
+
+def is_retrained(old: tuple, new: tuple) -> bool:
+    """
+    Decides whether the model files have been completely rewritten since they
+    were last loaded. Training writes the HMM last, and an HMM is meaningless
+    with a refit mixture, so a partially retrained model never counts. If
+    training left a completion marker, it must be newer than the last one seen
+    and than every model file.
+
+    param old: fingerprint of the model files when last loaded
+    param new: current fingerprint of the model files
+    return: whether new describes a complete, retrained model
+    """
+
+    models, done = new[:-1], new[-1]
+    if None in models:
+        return False
+
+    newest = max(stamp[0] for stamp in models)
+    if done is not None:
+        return done != old[-1] and done[0] >= newest
+
+    changed = all(stamp != prev for stamp, prev in zip(models, old[:-1]))
+    return changed and models[-1][0] >= newest
+
+
+class ModelRegistry:
+    """
+    Holds several named models, evicting the least recently used ones once
+    too many are loaded
+    """
+
+    def __init__(self, max_models=4, memory_budget=None, do_conditional=True):
+        """
+        param max_models: maximum number of models to keep loaded at once
+        param memory_budget: approximate upper bound (in bytes) on the total
+                             size of loaded models. None for no bound
+        param do_conditional: whether loaded models condition emissions on
+                              previous tokens
+        """
+
+        self.max_models = max_models
+        self.memory_budget = memory_budget
+        self.do_conditional = do_conditional
+        self.paths = {}
+        self.stamps = {}
+        self.models = OrderedDict()
+        self.lock = threading.RLock()
+
+    def register(self, name: str, model_path: Path):
+        """
+        Makes a model available under the given name. The model is not loaded
+        until it is first requested.
+
+        param name: name used to refer to the model
+        param model_path: directory containing saved model files
+        """
+
+        if type(model_path) == str:
+            model_path = Path(model_path)
+
+        with self.lock:
+            if self.paths.get(name) != model_path:
+                self.models.pop(name, None)
+                self.stamps[name] = fingerprint(model_path)
+            self.paths[name] = model_path
+
+    def get(self, name: str) -> LoadedModel:
+        """
+        Returns the named model, loading it from disk if necessary
+
+        param name: name of a registered model
+        return: the loaded model
+        """
+
+        with self.lock:
+            if name in self.models:
+                self.models.move_to_end(name)
+                return self.models[name]
+
+            if name not in self.paths:
+                raise KeyError('no model registered under name: %s' % name)
+            model_path = self.paths[name]
+
+        # load without holding the lock, so other models stay available
+        print('loading model', name)
+        model = LoadedModel(model_path, self.do_conditional)
+
+        with self.lock:
+            if name in self.models:
+                # loaded concurrently by another caller
+                self.models.move_to_end(name)
+                return self.models[name]
+
+            if self.paths.get(name) == model_path:
+                self.models[name] = model
+                self._evict(keep=name)
+            return model
+
+    def path(self, name: str) -> Path:
+        """
+        return: the model directory registered under name
+        """
+
+        with self.lock:
+            return self.paths[name]
+
+    def fingerprint(self, name: str) -> tuple:
+        """
+        return: fingerprint of the named model's files when it was loaded, or
+                when it was registered if it is not loaded
+        """
+
+        with self.lock:
+            if name in self.models:
+                return self.models[name].fingerprint
+            return self.stamps[name]
+
+    def swap(self, name: str, model: LoadedModel):
+        """
+        Replaces the named model with one that has already been loaded, e.g.
+        after retraining.
+
+        param name: name of a registered model
+        param model: the replacement model
+        """
+
+        with self.lock:
+            self.models[name] = model
+            self.models.move_to_end(name)
+            self._evict(keep=name)
+
+    def evict(self, name: str):
+        """
+        Unloads the named model. It remains registered, and will be reloaded
+        the next time it is requested.
+
+        param name: name of a registered model
+        """
+
+        with self.lock:
+            self.models.pop(name, None)
+
+    def loaded(self) -> list:
+        """
+        return: names of currently loaded models, least recently used first
+        """
+
+        with self.lock:
+            return list(self.models)
+
+    def memory_usage(self) -> int:
+        """
+        return: approximate total size (in bytes) of loaded models
+        """
+
+        with self.lock:
+            return sum(model.nbytes for model in self.models.values())
+
+    def _evict(self, keep):
+        for name in list(self.models):
+            if not self._over_limit():
+                break
+            if name != keep:
+                print('evicting model', name)
+                del self.models[name]
+
+    def _over_limit(self) -> bool:
+        if len(self.models) > self.max_models:
+            return True
+        return self.memory_budget is not None and self.memory_usage() > self.memory_budget
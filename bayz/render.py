@@ -0,0 +1,237 @@
+"""
+Renders committed bayz music to audio offline, without a browser. The
+synthesis mirrors the bayz beat WebAudio client in www/main.js: each line of
+a commit becomes a voice with its own oscillator and gain envelope, notes are
+timed according to the rhythm system described in bayz.music, and a commit
+loops for a number of cycles before the next one takes over. To render a
+saved session, run
+
+$ python -m bayz.render session.jsonl out.wav
+
+where session.jsonl contains one committed message per line, such as a
+BayzServer commit log (or is a .json file with a single message or a list of
+them). Audio is synthesized and written in fixed-size chunks, so long sets
+render in bounded memory.
+
+author: William Tong (wlt2115@columbia.edu)
+"""
+
+import argparse
+import json
+import wave
+
+from pathlib import Path
+
+import numpy as np
+
+SAMPLE_RATE = 44100
+CHUNK_SIZE = 2 ** 16
+
+""" Partials of the bell kernel, relative to the fundamental """
+BELL_PARTIALS = np.array([1, 2, 2.5, 3, 4, 5.3, 6.6, 8])
+
+""" Parameters of the warble kernel's frequency modulator """
+WARBLE_RATE = 15
+WARBLE_DEPTH = 25
+
+""" Envelope settings per instrument: (attack, sustain, decay) """
+ENVELOPES = {
+    'sine': (0.01, 0.1, 0.03),
+    'bell': (0.01, 0.01, 0.03),
+    'warble': (0.01, 0.1, 0.03)
+}
+
+""" Gap left between consecutive notes, as in the client """
+NOTE_GAP = 0.01
+
+
+class Voice:
+    """
+    One line of music played by one instrument, as scheduled by the client
+    """
+
+    def __init__(self, name, starts, stops, notes):
+        """
+        param name: name of the instrument
+        param starts: start times of each note, in seconds
+        param stops: stop times of each note, in seconds
+        param notes: midi values of each note
+        """
+
+        if name not in ENVELOPES:
+            raise ValueError('unknown instrument: %s' % name)
+
+        self.name = name
+        self.starts = np.asarray(starts, dtype=float)
+        self.freqs = midi_to_freq(np.asarray(notes, dtype=float))
+
+        attack, sustain, decay = ENVELOPES[name]
+        self.begin = self.starts[0]
+        self.end = np.max(stops) + 10 * decay
+
+        # oscillator phase at the start of each note, measured from the start
+        # of the voice. Wrapped at a period shared by every bell partial to
+        # keep phases small
+        spans = 2 * np.pi * self.freqs[:-1] * np.diff(self.starts)
+        self.phases = np.concatenate([[0], np.cumsum(spans)]) % (2 * np.pi * 10)
+
+        # gain follows setTargetAtTime: an exponential approach to the latest
+        # target, starting from wherever the previous approach left off
+        times = np.concatenate([starts, stops])
+        targets = np.concatenate([np.full(len(starts), sustain), np.zeros(len(stops))])
+        taus = np.concatenate([np.full(len(starts), attack), np.full(len(stops), decay)])
+        order = np.argsort(times, kind='stable')
+        self.times, self.targets, self.taus = times[order], targets[order], taus[order]
+
+        self.levels = np.zeros(len(self.times))
+        for k in range(1, len(self.times)):
+            elapsed = self.times[k] - self.times[k-1]
+            self.levels[k] = self.targets[k-1] + (self.levels[k-1] - self.targets[k-1]) \
+                * np.exp(-elapsed / self.taus[k-1])
+
+    def render(self, t: np.ndarray, sample_rate=SAMPLE_RATE) -> np.ndarray:
+        """
+        Synthesizes the voice over the given times. Oscillator phase is
+        computed from the start of the voice, so the output does not depend
+        on how time is split into chunks.
+
+        param t: sample times, in seconds
+        param sample_rate: sample rate, in Hz
+        return: audio samples
+        """
+
+        idx = np.maximum(np.searchsorted(self.starts, t, side='right') - 1, 0)
+        phase = self.phases[idx] + 2 * np.pi * self.freqs[idx] * (t - self.starts[idx])
+        if self.name == 'warble':
+            # integral of the modulator, WARBLE_DEPTH * sin(2 pi WARBLE_RATE t)
+            phase += WARBLE_DEPTH / WARBLE_RATE * (np.cos(2 * np.pi * WARBLE_RATE * self.begin)
+                                                   - np.cos(2 * np.pi * WARBLE_RATE * t))
+
+        if self.name == 'bell':
+            wave_ = np.sin(np.outer(phase, BELL_PARTIALS)).sum(axis=1)
+        else:
+            wave_ = np.sin(phase)
+
+        k = np.searchsorted(self.times, t, side='right') - 1
+        kk = np.maximum(k, 0)
+        gain = self.targets[kk] + (self.levels[kk] - self.targets[kk]) \
+            * np.exp(-(t - self.times[kk]) / self.taus[kk])
+        # silent outside the voice, as render skips chunks outside it
+        gain[(k < 0) | (t > self.end)] = 0
+
+        return gain * wave_
+
+
+def midi_to_freq(m):
+    return 2 ** ((m - 69) / 12) * 440
+
+
+def schedule(messages, cycles=4) -> 'tuple':
+    """
+    Lays out committed messages in time. Each deployed message replaces the
+    previous one and loops for the given number of cycles. Notes are assigned
+    durations in proportion to their rhythm, such that each line sums to the
+    cycleLength. A ValueError is raised for lines whose rhythm is empty,
+    negative, or sums to zero, as their notes cannot be laid out.
+
+    param messages: a message, as committed to BayzServer, or list of them
+    param cycles: number of cycles to play each message for
+    return: list of Voice objects and the total duration, in seconds
+    """
+
+    if type(messages) is dict:
+        messages = [messages]
+
+    voices = []
+    cursor = 0.
+    for message in messages:
+        if not message.get('deploy', True):
+            continue
+
+        cycle_length = message['cycleLength']
+        for line in message['sound']:
+            notes, rhythm = line['notes'], line['rhythm']
+            if len(notes) == 0:
+                continue
+
+            if len(rhythm) == 0 or min(rhythm) < 0 or sum(rhythm) <= 0:
+                raise ValueError('rhythm must be non-empty, non-negative and sum to more than zero: %s' % rhythm)
+
+            lengths = np.array([rhythm[i % len(rhythm)] for i in range(len(notes))], dtype=float)
+            offsets = np.concatenate([[0], np.cumsum(lengths)]) / lengths.sum() * cycle_length
+            cycle_starts = cursor + cycle_length * np.arange(cycles)
+
+            starts = (cycle_starts[:,None] + offsets[None,:-1]).flatten()
+            stops = (cycle_starts[:,None] + offsets[None,1:]).flatten() - NOTE_GAP
+            voices.append(Voice(line['name'], starts, stops, np.tile(notes, cycles)))
+
+        cursor += cycles * cycle_length
+
+    return voices, cursor
+
+
+def render(messages, out_path, cycles=4, sample_rate=SAMPLE_RATE, chunk_size=CHUNK_SIZE) -> float:
+    """
+    Renders committed messages to a 16-bit mono WAV file
+
+    param messages: a message, as committed to BayzServer, or list of them
+    param out_path: path of the WAV file to write
+    param cycles: number of cycles to play each message for
+    param sample_rate: sample rate of the output, in Hz
+    param chunk_size: number of samples to synthesize at a time
+    return: duration of the rendered audio, in seconds
+    """
+
+    voices, duration = schedule(messages, cycles)
+    if len(voices) > 0:
+        duration = max(duration, max(voice.end for voice in voices))
+    n_samples = int(np.ceil(duration * sample_rate))
+
+    with wave.open(str(out_path), 'wb') as fp:
+        fp.setnchannels(1)
+        fp.setsampwidth(2)
+        fp.setframerate(sample_rate)
+
+        for start in range(0, n_samples, chunk_size):
+            t = np.arange(start, min(start + chunk_size, n_samples)) / sample_rate
+            audio = np.zeros(len(t))
+            for voice in voices:
+                if voice.begin <= t[-1] and voice.end >= t[0]:
+                    audio += voice.render(t, sample_rate)
+
+            pcm = np.clip(audio, -1, 1) * (2 ** 15 - 1)
+            fp.writeframes(pcm.astype('<i2').tobytes())
+
+    return n_samples / sample_rate
+
+
+def load_messages(path: Path) -> list:
+    """
+    Reads committed messages from a .json file (one message or a list) or a
+    line-delimited .jsonl file (one message per line). Lines of a BayzServer
+    commit log are unwrapped to their messages.
+
+    param path: path to the messages
+    return: list of messages
+    """
+
+    with path.open() as fp:
+        if path.suffix == '.jsonl':
+            messages = [json.loads(line) for line in fp if line.strip()]
+            return [msg['data'] if 'data' in msg else msg for msg in messages]
+
+        messages = json.load(fp)
+        return [messages] if type(messages) is dict else messages
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render committed bayz music to a WAV file')
+    parser.add_argument('messages', type=Path, help='.json or .jsonl file of committed messages')
+    parser.add_argument('out', type=Path, help='WAV file to write')
+    parser.add_argument('--cycles', type=int, default=4, help='cycles to play each message for')
+    parser.add_argument('--sample-rate', type=int, default=SAMPLE_RATE)
+    args = parser.parse_args()
+
+    duration = render(load_messages(args.messages), args.out,
+                      cycles=args.cycles, sample_rate=args.sample_rate)
+    print('rendered %.1f seconds of audio to %s' % (duration, args.out))
@@ -0,0 +1,158 @@
+"""
+Replays a recorded commit log against a bayz server, to check that the server
+holds up under realistic traffic. To replay a log, run
+
+$ python -m bayz.replay commits.jsonl --speed 10 --clients 50
+
+which starts a server, feeds it the logged commits at 10x the recorded pace,
+and polls it with 50 simulated bayz beat clients. Commit logs are written by
+BayzServer when it is given a log_path. Once the log is exhausted, a report of
+request throughput, latency and dropped updates is printed. An update is
+dropped if it is overwritten by the next commit before any client receives it.
+Each replayed commit carries its index in the log under REPLAY_KEY, so repeated
+commits of identical music are still told apart.
+
+BayzServer keeps the music it serves in the module-global globalData, which
+every server in a process shares. Run replays in their own process, never
+alongside a live server or another replay, or they will overwrite each other's
+commits. Clients only ever poll: there is no streaming mode, and the closest
+equivalent is a poll interval of 0, which polls back-to-back.
+
+author: William Tong (wlt2115@columbia.edu)
+"""
+
+import argparse
+import http.client
+import json
+import threading
+import time
+
+from pathlib import Path
+
+import numpy as np
+
+from bayz.server import BayzServer
+
+REPLAY_KEY = 'replayIndex'
+
+def load_log(path: Path) -> list:
+    """
+    Reads a commit log written by BayzServer
+
+    param path: path to the commit log
+    return: list of (time, message) pairs, in order of commit
+    """
+
+    entries = []
+    with path.open() as fp:
+        for line in fp:
+            if line.strip():
+                entry = json.loads(line)
+                entries.append((entry['time'], entry['data']))
+    return entries
+
+
+def replay(entries: list, port=42710, speed=1., clients=10, poll_interval=1., timeout=5.) -> dict:
+    """
+    Commits the logged messages to a fresh server while simulated clients
+    poll it. Must run in a process with no other BayzServer, as servers share
+    the module-global globalData
+
+    param entries: (time, message) pairs, as returned by load_log
+    param port: port to run the server on
+    param speed: factor by which to speed up the recorded pace
+    param clients: number of simulated clients
+    param poll_interval: time between polls of each client, in seconds of
+                         recorded time. Set to 0 to poll back-to-back
+    param timeout: time to wait for a response, in seconds
+
+    return: report of throughput, latency and dropped updates
+    """
+
+    srv = BayzServer(port=port)
+    srv.start()
+    time.sleep(0.1)
+
+    received = set()
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    done = threading.Event()
+
+    def _client():
+        while not done.is_set():
+            start = time.perf_counter()
+            try:
+                conn = http.client.HTTPConnection('localhost', port, timeout=timeout)
+                conn.request('GET', '/')
+                data = json.loads(conn.getresponse().read())
+                conn.close()
+            except (OSError, http.client.HTTPException, ValueError):
+                with lock:
+                    errors[0] += 1
+                done.wait(poll_interval / speed)
+                continue
+
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if REPLAY_KEY in data:
+                    received.add(data[REPLAY_KEY])
+            done.wait(poll_interval / speed)
+
+    threads = [threading.Thread(target=_client, daemon=True) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+
+    begin = time.perf_counter()
+    origin = entries[0][0] if len(entries) > 0 else 0
+    for i, (stamp, msg) in enumerate(entries):
+        delay = (stamp - origin) / speed - (time.perf_counter() - begin)
+        if delay > 0:
+            time.sleep(delay)
+        srv.commit(dict(msg, **{REPLAY_KEY: i}))
+
+    # let clients pick up the final commit
+    time.sleep(2 * max(poll_interval / speed, 0.1))
+    done.set()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - begin
+    srv.stop()
+
+    latencies = np.array(latencies) * 1000
+    percentiles = np.percentile(latencies, [50, 95, 99]) if len(latencies) > 0 else [np.nan] * 3
+    dropped = len(entries) - len(received)
+
+    return {
+        'commits': len(entries),
+        'requests': len(latencies),
+        'errors': errors[0],
+        'duration_s': duration,
+        'throughput_rps': len(latencies) / duration,
+        'latency_p50_ms': percentiles[0],
+        'latency_p95_ms': percentiles[1],
+        'latency_p99_ms': percentiles[2],
+        'latency_max_ms': latencies.max() if len(latencies) > 0 else np.nan,
+        'dropped_updates': dropped
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a bayz commit log against a server')
+    parser.add_argument('log', type=Path, help='commit log written by BayzServer')
+    parser.add_argument('--speed', type=float, default=1., help='speed-up over the recorded pace')
+    parser.add_argument('--clients', type=int, default=10, help='number of simulated clients')
+    parser.add_argument('--interval', type=float, default=1.,
+                        help='seconds between polls per client. 0 to poll back-to-back '
+                             '(clients always poll, there is no streaming mode)')
+    parser.add_argument('--port', type=int, default=42710)
+    args = parser.parse_args()
+
+    entries = load_log(args.log)
+    print('replaying %d commits' % len(entries))
+    report = replay(entries, port=args.port, speed=args.speed,
+                    clients=args.clients, poll_interval=args.interval)
+
+    for key, value in report.items():
+        print('%-16s %s' % (key, round(value, 2) if type(value) is not int else value))
@@ -26,25 +26,38 @@ messaging system. One message has the structure:
 
 For more information about the rhythm system, see bayz.music.py.
 
+If given a log_path, the server appends every committed message to a commit
+log, one JSON object per line:
+
+{"time": [float], "data": [message]}
+
+where time is the UNIX timestamp of the commit. Logs can be replayed against
+a server with bayz.replay, or rendered to audio with bayz.render.
+
 author: William Tong (wlt2115@columbia.edu)
 """
 
 import http.server
 import json
 import threading
+import time
 
 """ Tracks the global music information to be committed to the bayz beat """
 globalData = {}
 
 class BayzServer:
-    def __init__(self, port=42700):
+    def __init__(self, port=42700, log_path=None):
         """
         param port: port to listen for bayz beats
+        param log_path: file to append committed messages to. None to disable
+                        logging
         """
 
         self.port = port
         self.httpd = None
         self.data = {}
+        self.log_path = log_path
+        self.log_lock = threading.Lock()
 
     def start(self):
         """
@@ -71,6 +84,11 @@ class BayzServer:
         global globalData
         globalData = data
 
+        if self.log_path is not None:
+            line = json.dumps({'time': time.time(), 'data': data}, separators=(',', ':'))
+            with self.log_lock, open(self.log_path, 'a') as fp:
+                fp.write(line + '\n')
+
     def stop(self):
         """
         Stops the server
@@ -0,0 +1,279 @@
+"""
+Standalone generation service, letting several bands on one machine share a
+single pool of warmed-up models. Each worker process loads the models once,
+and phrases are requested over HTTP. To launch a service, run
+
+$ python -m bayz.service --model default=save/ --model chorales=save_chorales/
+
+which listens on the default port 42701. To stop the service, hit <enter>.
+Bands then connect with
+
+    b = Band(service=GenerationClient())
+
+The protocol is a single JSON endpoint. A request for k phrases from model m
+
+GET /generate?model=m&k=k[&best_of=n&min_score=x&seed=s]
+
+is answered with
+
+{
+    model: [str],                 // name of the model sampled from
+    phrases: [list of lists]      // k sequences of midi values
+}
+
+and GET /models lists the names of the models available. After retraining,
+GET /reload restarts the workers, which load every model from disk again.
+Given a seed, the
+phrases are identical no matter how many workers the service runs, as each
+phrase is sampled from its own child of a numpy SeedSequence.
+
+author: William Tong (wlt2115@columbia.edu)
+"""
+
+import argparse
+import http.server
+import json
+import random
+import threading
+import urllib.parse
+import urllib.request
+
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+
+from bayz.registry import ModelRegistry
+
+""" Models loaded by the current worker process """
+workerRegistry = None
+
+class GenerationService:
+    def __init__(self, models={'default': Path('save/')}, port=42701, workers=None, do_conditional=True):
+        """
+        param models: dictionary of model names to locations of saved model
+                      files
+        param port: port to listen for generation requests
+        param workers: number of worker processes. Defaults to the CPU count
+        param do_conditional: whether to condition each sampled token on the
+                              ones before it
+        """
+
+        self.models = {name: Path(path) for name, path in models.items()}
+        self.port = port
+        self.workers = workers
+        self.do_conditional = do_conditional
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        self.httpd = None
+
+    def start(self):
+        """
+        Starts the worker pool, and serves requests in a separate thread
+        """
+
+        with self.pool_lock:
+            if self.pool is None:
+                self.pool = self._make_pool()
+
+        def _startServer():
+            server_address = ('', self.port)
+            self.httpd = http.server.ThreadingHTTPServer(server_address, GenerationRequestHandler)
+            self.httpd.service = self
+            self.httpd.serve_forever()
+
+        if self.httpd is None:
+            process = threading.Thread(target=_startServer)
+            process.daemon = True
+            process.start()
+
+    def generate(self, k, model='default', best_of=1, min_score=None, seed=None) -> list:
+        """
+        Samples phrases from the worker pool, spreading them across workers
+
+        param k: number of phrases to sample
+        param model: name of the model to sample from
+        param best_of: number of candidates to score per phrase, see
+                       bayz.registry.LoadedModel.sample
+        param min_score: log-likelihood at which to accept a candidate
+        param seed: seed for reproducible sampling. None for fresh entropy
+        return: list of k phrases, each a list of midi values
+        """
+
+        if model not in self.models:
+            raise KeyError('no model registered under name: %s' % model)
+
+        seeds = np.random.SeedSequence(seed).spawn(k)
+        with self.pool_lock:
+            jobs = [self.pool.submit(_sample, model, best_of, min_score, s) for s in seeds]
+        return [job.result() for job in jobs]
+
+    def reload(self):
+        """
+        Replaces the worker pool with a fresh one, whose workers load the
+        models from disk again, e.g. after retraining. Requests already
+        submitted finish on the old pool.
+        """
+
+        with self.pool_lock:
+            old, self.pool = self.pool, self._make_pool()
+
+        if old is not None:
+            old.shutdown()
+
+    def stop(self):
+        """
+        Stops the server and shuts down the worker pool
+        """
+
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd = None
+
+        with self.pool_lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.shutdown()
+
+    def _make_pool(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=self.workers,
+                                   initializer=_init_worker,
+                                   initargs=(self.models, self.do_conditional))
+
+
+def _init_worker(models, do_conditional):
+    global workerRegistry
+
+    # forked workers inherit the parent's random state, so reseed each one
+    # from fresh entropy to keep unseeded draws independent across workers
+    random.seed()
+    np.random.seed()
+
+    workerRegistry = ModelRegistry(max_models=len(models), do_conditional=do_conditional)
+    for name, path in models.items():
+        workerRegistry.register(name, path)
+        workerRegistry.get(name)
+
+
+def _sample(model, best_of, min_score, seed) -> list:
+    rng = np.random.default_rng(seed)
+    return workerRegistry.get(model).sample(best_of, min_score, rng)
+
+
+class GenerationRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Handles requests for phrases from bands
+    """
+
+    def do_GET(self):
+        service = self.server.service
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+
+        if url.path == '/models':
+            self._send_json(200, {'models': list(service.models)})
+        elif url.path == '/reload':
+            try:
+                service.reload()
+                self._send_json(200, {'models': list(service.models)})
+            except Exception as e:
+                self._send_json(500, {'error': '%s: %s' % (type(e).__name__, e)})
+        elif url.path == '/generate':
+            model = query.get('model', ['default'])[0]
+            try:
+                k = int(query.get('k', ['1'])[0])
+                best_of = int(query.get('best_of', ['1'])[0])
+                min_score = float(query['min_score'][0]) if 'min_score' in query else None
+                seed = int(query['seed'][0]) if 'seed' in query else None
+                phrases = service.generate(k, model, best_of, min_score, seed)
+                self._send_json(200, {'model': model, 'phrases': phrases})
+            except (KeyError, ValueError) as e:
+                self._send_json(400, {'error': str(e)})
+            except Exception as e:
+                self._send_json(500, {'error': '%s: %s' % (type(e).__name__, e)})
+        else:
+            self._send_json(404, {'error': 'unknown path: %s' % url.path})
+
+    def _send_json(self, code, data):
+        self.send_response(code)
+        self.send_header('Content-type', 'application/json; charset=utf-8')
+        self.end_headers()
+        self.wfile.write(json.dumps(data).encode('utf-8'))
+
+    def log_message(self, format, *args):
+        return # silence logging
+
+
+class GenerationClient:
+    """
+    Requests phrases from a generation service without blocking the caller
+    """
+
+    def __init__(self, address='http://localhost:42701', timeout=60):
+        """
+        param address: address of the generation service
+        param timeout: time to wait for a response, in seconds
+        """
+
+        self.address = address
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=4)
+
+    def request(self, k=1, model='default', best_of=1, min_score=None, seed=None) -> 'Future':
+        """
+        Requests phrases from the service
+
+        param k: number of phrases to request
+        param model: name of the model to sample from
+        param best_of: number of candidates to score per phrase
+        param min_score: log-likelihood at which to accept a candidate
+        param seed: seed for reproducible sampling
+        return: a concurrent.futures.Future resolving to a list of phrases
+        """
+
+        return self.executor.submit(self._fetch, k, model, best_of, min_score, seed)
+
+    def reload(self) -> 'Future':
+        """
+        Asks the service to load its models from disk again. This affects
+        every band sharing the service.
+
+        return: a concurrent.futures.Future resolving to the names of the
+                reloaded models
+        """
+
+        return self.executor.submit(self._reload)
+
+    def _fetch(self, k, model, best_of, min_score, seed) -> list:
+        params = {'model': model, 'k': k, 'best_of': best_of}
+        if min_score is not None:
+            params['min_score'] = min_score
+        if seed is not None:
+            params['seed'] = seed
+
+        query = urllib.parse.urlencode(params)
+        with urllib.request.urlopen('%s/generate?%s' % (self.address, query), timeout=self.timeout) as resp:
+            return json.loads(resp.read())['phrases']
+
+    def _reload(self) -> list:
+        with urllib.request.urlopen('%s/reload' % self.address, timeout=self.timeout) as resp:
+            return json.loads(resp.read())['models']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve generated phrases to bayz bands')
+    parser.add_argument('--model', action='append', default=[],
+                        help='model to serve, as name=path. Defaults to default=save/')
+    parser.add_argument('--port', type=int, default=42701)
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--unconditional', action='store_true',
+                        help='sample tokens without conditioning on previous ones, which is much faster')
+    args = parser.parse_args()
+
+    models = dict(spec.split('=', 1) for spec in args.model) or {'default': 'save/'}
+    srv = GenerationService(models, port=args.port, workers=args.workers,
+                            do_conditional=not args.unconditional)
+    srv.start()
+    print('serving models', ', '.join(models), 'on port', args.port)
+    input()
+    srv.stop()
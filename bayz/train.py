@@ -43,6 +43,9 @@ plot_path = save_path / 'plot.png'
 
 hmm_path = save_path / 'hmm.pk'
 
+""" Touched once all model files are written, signalling a complete model """
+done_path = save_path / 'done'
+
 def fetch_texts(cache=True) -> list:
     """
     Fetches the Bach corpus from music21.
@@ -248,4 +251,5 @@ if __name__ == '__main__':
     sequences = texts_to_seqs(texts, embedding.wv, labels)
     hmm = train_hmm(sequences)
     print('fitted weight matrix', hmm.transmat_)
+    done_path.touch()
     print('done!')